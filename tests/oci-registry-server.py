@@ -1,22 +1,48 @@
 #!/usr/bin/python3
 
 import argparse
-import base64
+import binascii
+import collections
+import functools
 import hashlib
 import json
 import os
 import ssl
+import tempfile
+import threading
 import time
 
 from urllib.parse import parse_qs
 import http.server as http_server
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+
+    def json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+
+    json_loads = orjson.loads
+else:
+
+    def json_dumps(obj):
+        return json.dumps(obj, indent=4).encode("UTF-8")
+
+    json_loads = json.loads
+
 repositories = {}
-icons = {}
+icons_dir = None
 signatures = {}
 
 required_token = None
 
+# Held while modifying the registry or rebuilding the index; other GET
+# requests only do lookups and don't take it
+lock = threading.Lock()
+
 
 def get_index():
     results = []
@@ -25,23 +51,87 @@ def get_index():
         results.append(
             {
                 "Name": repo_name,
-                "Images": repo["images"],
+                "Images": list(repo["images_by_tag"].values()),
                 "Lists": [],
             }
         )
 
-    return json.dumps({"Registry": "/", "Results": results}, indent=4).encode("UTF-8")
+    return json_dumps({"Registry": "/", "Results": results})
+
+
+def get_repository(repo_name):
+    repo = repositories.get(repo_name)
+    if repo is None:
+        repo = repositories[repo_name] = {
+            "blobs": {},
+            "manifests": {},
+            "images_by_tag": {},
+        }
+    return repo
+
+
+MAX_OPEN_FILES = 128
+
+# Served files are content-addressed and never change, so keep the most
+# recently used ones open rather than looking up the path on every request
+open_files = collections.OrderedDict()
+open_files_lock = threading.Lock()
+
+
+def open_cached_file(path):
+    """Return a new file descriptor for path and its size; the caller must close the descriptor."""
+    with open_files_lock:
+        entry = open_files.get(path)
+        if entry is None:
+            fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+            entry = open_files[path] = (fd, os.fstat(fd).st_size)
+            if len(open_files) > MAX_OPEN_FILES:
+                _, (old_fd, _) = open_files.popitem(last=False)
+                os.close(old_fd)
+        else:
+            open_files.move_to_end(path)
+
+        # Hand out a duplicate so evicting the entry can't close it under
+        # another request
+        fd, size = entry
+        return os.dup(fd), size
+
+
+@functools.lru_cache(maxsize=256)
+def parse_json_file(path, mtime_ns):
+    with open(path, "rb") as f:
+        return json_loads(f.read())
+
+
+def load_json(path):
+    """Parse a JSON file, reusing the result until its mtime changes.
+
+    Only use this for files named by their digest, and don't modify the result.
+    """
+    return parse_json_file(path, os.stat(path).st_mtime_ns)
 
 
 def cache_icon(data_uri):
-    prefix = "data:image/png;base64,"
-    assert data_uri.startswith(prefix)
-    data = base64.b64decode(data_uri[len(prefix) :])
-    h = hashlib.sha256()
-    h.update(data)
-    digest = h.hexdigest()
+    prefix = b"data:image/png;base64,"
+    uri = data_uri.encode("ascii")
+    assert uri.startswith(prefix)
+    # a2b_base64() reads the view in place, unlike b64decode(), which copies
+    # the payload into a new bytes object first
+    data = binascii.a2b_base64(memoryview(uri)[len(prefix) :])
+    digest = hashlib.sha256(data, usedforsecurity=False).hexdigest()
     filename = digest + ".png"
-    icons[filename] = data
+    try:
+        fd = os.open(
+            os.path.join(icons_dir, filename),
+            os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC,
+            0o644,
+        )
+    except FileExistsError:
+        # Same digest, so the existing file has the same contents
+        pass
+    else:
+        with open(fd, "wb") as f:
+            f.write(data)
 
     return "/icons/" + filename
 
@@ -54,34 +144,109 @@ def get_etag():
     return str(server_start_time) + "-" + str(serial)
 
 
-def modified():
-    global serial
-    serial += 1
+index_cache = {"serial": -1, "body": b"", "etag": ""}
 
 
-class RequestHandler(http_server.BaseHTTPRequestHandler):
-    def check_route(self, route):
-        parts = self.path.split("?", 1)
-        path = parts[0].split("/")
+def get_cached_index():
+    """Return the serialized index and its etag, rebuilding them only after a modification."""
+    with lock:
+        if index_cache["serial"] != serial:
+            index_cache["body"] = get_index()
+            index_cache["etag"] = get_etag()
+            index_cache["serial"] = serial
+        return index_cache["body"], index_cache["etag"]
 
-        route_path = route.split("/")
-        if len(route_path) != len(path):
-            return False
 
-        matches = {}
-        for i in range(1, len(route_path)):
-            if route_path[i][0] == "@":
-                matches[route_path[i][1:]] = path[i]
-            elif route_path[i] != path[i]:
-                return False
+def modified():
+    global serial
+    serial += 1
+    index_cache["serial"] = -1
+
+
+ROUTES = [
+    ("GET", "/v2/@repo_name/blobs/@digest", "get_blob"),
+    ("GET", "/v2/@repo_name/manifests/@ref", "get_manifest"),
+    ("GET", "/index/static", "get_registry_index"),
+    ("GET", "/index/dynamic", "get_registry_index"),
+    ("GET", "/icons/@filename", "get_icon"),
+    ("GET", "/sig-lookaside/@ref/@sig", "get_signature"),
+    ("POST", "/testing/@repo_name/@tag", "post_image"),
+    ("POST", "/testing-sig/@repo_name/@digest", "post_signature"),
+    ("POST", "/testing-auth/configure", "post_auth_config"),
+    ("DELETE", "/testing/@repo_name/@ref", "delete_image"),
+    ("DELETE", "/testing-sig/@repo_name/@digest", "delete_signature"),
+]
+
+
+def compile_routes(routes):
+    """Build a trie of path components for dispatch().
+
+    A "@" key matches any component, and the None key of a node maps each
+    method to its (handler, parameter names).
+    """
+    trie = {}
+    for method, route, handler in routes:
+        node = trie
+        names = []
+        for part in route.split("/")[1:]:
+            if part[0] == "@":
+                names.append(part[1:])
+                part = "@"
+            node = node.setdefault(part, {})
+        node.setdefault(None, {})[method] = (handler, tuple(names))
+
+    return trie
+
+
+route_trie = compile_routes(ROUTES)
+
+ICON_RESPONSE_HEADERS = (
+    b"HTTP/1.1 200 OK\r\n"
+    b"Content-Type: image/png\r\n"
+    b"Cache-Control: no-cache\r\n"
+    b"Content-Length: %d\r\n"
+    b"\r\n"
+)
 
-        self.matches = matches
-        if len(parts) == 1:
-            self.query = {}
-        else:
-            self.query = parse_qs(parts[1], keep_blank_values=True)
 
-        return True
+class RequestHandler(http_server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Buffer responses so the headers and a small body go out in a single
+    # write (and a single TLS record); handle_one_request() flushes this
+    wbufsize = 16384
+
+    def dispatch(self, method):
+        """Return the handler for this request's path, or None if no route matches."""
+        path, _, query = self.path.partition("?")
+
+        node = route_trie
+        values = []
+        for part in path.split("/")[1:]:
+            child = node.get(part)
+            if child is None:
+                child = node.get("@")
+                if child is None:
+                    return None
+                values.append(part)
+            node = child
+
+        try:
+            handler, names = node[None][method]
+        except KeyError:
+            return None
+
+        self.matches = dict(zip(names, values))
+        self.query_string = query
+        self.parsed_query = None
+
+        return getattr(self, handler)
+
+    @property
+    def query(self):
+        # Only a few POST handlers look at the query, so parse it on demand
+        if self.parsed_query is None:
+            self.parsed_query = parse_qs(self.query_string, keep_blank_values=True)
+        return self.parsed_query
 
     def check_auth(self):
         """Return True if auth is not required or the Authorization: Bearer header matches the required token."""
@@ -92,70 +257,22 @@ class RequestHandler(http_server.BaseHTTPRequestHandler):
             return False
         return auth_header[len("Bearer "):] == required_token
 
-    def do_GET(self):
-        response = 404
-        response_string = b""
-        response_content_type = "application/octet-stream"
-
-        add_headers = {}
-
-        def get_file_contents(repo_name, type, ref):
-            try:
-                path = repositories[repo_name][type][ref]
-                with open(path, "rb") as f:
-                    return 200, f.read()
-            except KeyError:
-                return 404, b""
-
-        if self.check_route("/v2/@repo_name/blobs/@digest"):
-            if not self.check_auth():
-                self.send_response(401)
-                self.end_headers()
-                return
-            repo_name = self.matches["repo_name"]
-            digest = self.matches["digest"]
-            response, response_string = get_file_contents(repo_name, "blobs", digest)
-        elif self.check_route("/v2/@repo_name/manifests/@ref"):
-            if not self.check_auth():
-                self.send_response(401)
-                self.end_headers()
-                return
-            repo_name = self.matches["repo_name"]
-            ref = self.matches["ref"]
-            response, response_string = get_file_contents(repo_name, "manifests", ref)
-        elif self.check_route("/index/static") or self.check_route("/index/dynamic"):
-            etag = get_etag()
-            add_headers["Etag"] = etag
-            if self.headers.get("If-None-Match") == etag:
-                response = 304
-                response_string = b""
-            else:
-                response = 200
-                response_string = get_index()
-        elif self.check_route("/icons/@filename"):
-            response = 200
-            response_string = icons[self.matches["filename"]]
-            response_content_type = "image/png"
-        elif self.check_route("/sig-lookaside/@ref/@sig"):
-            ref = self.matches["ref"]
-            sig = self.matches["sig"]
-            index = int(sig.removeprefix("signature-")) - 1
-            try:
-                response = 200
-                response_string = signatures[ref][index]
-            except (KeyError, IndexError):
-                response = 404
-
+    def send_headers(
+        self,
+        response,
+        content_length,
+        response_content_type="application/octet-stream",
+        add_headers=None,
+    ):
         assert isinstance(response, int)
-        assert isinstance(response_string, bytes)
         assert isinstance(response_content_type, str)
 
-        add_headers["Content-Length"] = len(response_string)
-
         self.send_response(response)
-        for k, v in list(add_headers.items()):
+        for k, v in (add_headers or {}).items():
             self.send_header(k, v)
 
+        self.send_header("Content-Length", content_length)
+
         if response == 200:
             self.send_header("Content-Type", response_content_type)
 
@@ -164,158 +281,289 @@ class RequestHandler(http_server.BaseHTTPRequestHandler):
 
         self.end_headers()
 
-        self.wfile.write(response_string)
+    def send_empty_response(self, response):
+        # Keep-alive clients rely on Content-Length to find the end of the response
+        self.send_response(response)
+        self.send_header("Content-Length", 0)
+        self.end_headers()
+
+    def send_content(
+        self,
+        response,
+        response_string=b"",
+        response_content_type="application/octet-stream",
+        add_headers=None,
+    ):
+        assert isinstance(response_string, bytes)
+
+        self.send_headers(
+            response, len(response_string), response_content_type, add_headers
+        )
+        if self.command != "HEAD":
+            self.wfile.write(response_string)
+
+    def send_file(
+        self, path, response_content_type="application/octet-stream", add_headers=None
+    ):
+        fd, size = open_cached_file(path)
+        try:
+            self.send_headers(200, size, response_content_type, add_headers)
+            self.send_file_body(fd, size)
+        finally:
+            os.close(fd)
+
+    def send_file_body(self, fd, size):
+        if self.command == "HEAD":
+            return
+        self.wfile.flush()
+
+        # Duplicated descriptors share their file offset, so always read
+        # at explicit offsets rather than seeking
+        offset = 0
+        while offset < size:
+            if isinstance(self.connection, ssl.SSLSocket):
+                # TLS has to be encrypted in userspace, so sendfile() can't be used
+                data = os.pread(fd, min(size - offset, 65536), offset)
+                if data:
+                    self.connection.sendall(data)
+                sent = len(data)
+            else:
+                sent = os.sendfile(self.connection.fileno(), fd, offset, size - offset)
+            if sent == 0:
+                raise EOFError("File shrank while sending it")
+            offset += sent
+
+    def get_file_contents(self, type, ref):
+        if not self.check_auth():
+            self.send_empty_response(401)
+            return
+
+        try:
+            entry = repositories[self.matches["repo_name"]][type][ref]
+        except KeyError:
+            self.send_content(404)
+            return
+
+        # Content is addressed by digest, so the digest is a strong etag;
+        # manifests may also be looked up by tag and store their digest
+        if type == "manifests":
+            path, digest = entry
+        else:
+            path, digest = entry, ref
+
+        etag = '"' + digest + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_content(304, add_headers={"Etag": etag})
+        else:
+            try:
+                self.send_file(path, add_headers={"Etag": etag})
+            except FileNotFoundError:
+                # Layers are registered from the manifest, so the file
+                # may be missing from the OCI directory
+                self.send_content(404)
+
+    def get_blob(self):
+        self.get_file_contents("blobs", self.matches["digest"])
+
+    def get_manifest(self):
+        self.get_file_contents("manifests", self.matches["ref"])
+
+    def get_registry_index(self):
+        index, etag = get_cached_index()
+        if self.headers.get("If-None-Match") == etag:
+            self.send_content(304, add_headers={"Etag": etag})
+        else:
+            self.send_content(200, index, add_headers={"Etag": etag})
+
+    def get_icon(self):
+        # Icons are only ever stored as <digest>.png; this also keeps
+        # "." and ".." from opening a directory
+        filename = self.matches["filename"]
+        if not filename.endswith(".png"):
+            self.send_content(404)
+            return
+
+        try:
+            fd, size = open_cached_file(os.path.join(icons_dir, filename))
+        except FileNotFoundError:
+            self.send_content(404)
+            return
+
+        # Icon responses always have the same headers, so write them in
+        # one go instead of formatting each through send_header()
+        try:
+            self.log_request(200)
+            self.wfile.write(ICON_RESPONSE_HEADERS % size)
+            self.send_file_body(fd, size)
+        finally:
+            os.close(fd)
+
+    def get_signature(self):
+        ref = self.matches["ref"]
+        sig = self.matches["sig"]
+        index = int(sig.removeprefix("signature-")) - 1
+        try:
+            self.send_content(200, signatures[ref][index])
+        except (KeyError, IndexError):
+            self.send_content(404)
+
+    def do_GET(self):
+        handler = self.dispatch("GET")
+        if handler is None:
+            self.send_content(404)
+        else:
+            handler()
 
     def do_HEAD(self):
         return self.do_GET()
 
-    def do_POST(self):
-        if self.check_route("/testing/@repo_name/@tag"):
-            repo_name = self.matches["repo_name"]
-            tag = self.matches["tag"]
-            d = self.query["d"][0]
-            detach_icons = "detach-icons" in self.query
-
-            repo = repositories.setdefault(repo_name, {})
-            blobs = repo.setdefault("blobs", {})
-            manifests = repo.setdefault("manifests", {})
-            images = repo.setdefault("images", [])
-
-            with open(os.path.join(d, "index.json")) as f:
-                index = json.load(f)
-
-            manifest_digest = index["manifests"][0]["digest"]
-            manifest_path = os.path.join(d, "blobs", *manifest_digest.split(":"))
-            manifests[manifest_digest] = manifest_path
-            manifests[tag] = manifest_path
-
-            with open(manifest_path) as f:
-                manifest = json.load(f)
-
-            config_digest = manifest["config"]["digest"]
-            config_path = os.path.join(d, "blobs", *config_digest.split(":"))
-
-            with open(config_path) as f:
-                config = json.load(f)
-
-            for dig in os.listdir(os.path.join(d, "blobs", "sha256")):
-                digest = "sha256:" + dig
-                path = os.path.join(d, "blobs", "sha256", dig)
-                if digest != manifest_digest:
-                    blobs[digest] = path
-
-            if detach_icons:
-                for size in (64, 128):
-                    annotation = "org.freedesktop.appstream.icon-{}".format(size)
-                    icon = manifest.get("annotations", {}).get(annotation)
+    def post_image(self):
+        repo_name = self.matches["repo_name"]
+        tag = self.matches["tag"]
+        d = self.query["d"][0]
+        detach_icons = "detach-icons" in self.query
+
+        repo = get_repository(repo_name)
+        blobs = repo["blobs"]
+        manifests = repo["manifests"]
+        images_by_tag = repo["images_by_tag"]
+
+        # Tests rewrite index.json in place, possibly within the same mtime
+        # tick, so it isn't cached; it's tiny anyway
+        with open(os.path.join(d, "index.json"), "rb") as f:
+            index = json_loads(f.read())
+
+        # Delete old versions; the new image is re-added at the end, so the
+        # dict's insertion order is the order images appear in the index
+        old = images_by_tag.pop(tag, None)
+        if old is not None:
+            del manifests[old["Digest"]]
+
+        manifest_digest = index["manifests"][0]["digest"]
+        manifest_path = os.path.join(d, "blobs", *manifest_digest.split(":"))
+        manifests[manifest_digest] = (manifest_path, manifest_digest)
+        manifests[tag] = (manifest_path, manifest_digest)
+
+        manifest = load_json(manifest_path)
+
+        config_digest = manifest["config"]["digest"]
+        config_path = os.path.join(d, "blobs", *config_digest.split(":"))
+
+        config = load_json(config_path)
+
+        blobs[config_digest] = config_path
+        for layer in manifest["layers"]:
+            layer_digest = layer["digest"]
+            blobs[layer_digest] = os.path.join(d, "blobs", *layer_digest.split(":"))
+
+        # Copy these, as the parsed manifest and config are shared with later uploads
+        annotations = dict(manifest.get("annotations", {}))
+        labels = dict(config.get("config", {}).get("Labels", {}))
+
+        if detach_icons:
+            for size in (64, 128):
+                annotation = "org.freedesktop.appstream.icon-{}".format(size)
+                icon = annotations.get(annotation)
+                if icon:
+                    annotations[annotation] = cache_icon(icon)
+                else:
+                    icon = labels.get(annotation)
                     if icon:
-                        path = cache_icon(icon)
-                        manifest["annotations"][annotation] = path
-                    else:
-                        icon = (
-                            config.get("config", {}).get("Labels", {}).get(annotation)
-                        )
-                        if icon:
-                            path = cache_icon(icon)
-                            config["config"]["Labels"][annotation] = path
-
-            image = {
-                "Tags": [tag],
-                "Digest": manifest_digest,
-                "MediaType": "application/vnd.oci.image.manifest.v1+json",
-                "OS": config["os"],
-                "Architecture": config["architecture"],
-                "Annotations": manifest.get("annotations", {}),
-                "Labels": config.get("config", {}).get("Labels", {}),
-            }
+                        labels[annotation] = cache_icon(icon)
 
-            # Delete old versions
-            for i in images:
-                if tag in i["Tags"]:
-                    images.remove(i)
-                    del manifests[i["Digest"]]
+        image = {
+            "Tags": [tag],
+            "Digest": manifest_digest,
+            "MediaType": "application/vnd.oci.image.manifest.v1+json",
+            "OS": config["os"],
+            "Architecture": config["architecture"],
+            "Annotations": annotations,
+            "Labels": labels,
+        }
 
-            images.append(image)
+        images_by_tag[tag] = image
 
-            modified()
-            self.send_response(200)
-            self.end_headers()
-            return
-        elif self.check_route("/testing-sig/@repo_name/@digest"):
-            repo_name = self.matches["repo_name"]
-            digest = self.matches["digest"]
-            s = self.query["s"][0]
-
-            with open(s, "rb") as f:
-                signature_bytes = f.read()
-
-            digest = digest.replace(":", "=")
-            ref = f"{repo_name}@{digest}"
-            sigs = signatures.setdefault(ref, [])
-            sigs.append(signature_bytes)
-            self.send_response(200)
-            self.end_headers()
-        elif self.check_route("/testing-auth/configure"):
-            global required_token
-            required_token = self.query.get("token", [None])[0]
-
-            self.send_response(200)
-            self.end_headers()
+        modified()
+        self.send_empty_response(200)
+
+    def post_signature(self):
+        repo_name = self.matches["repo_name"]
+        digest = self.matches["digest"]
+        s = self.query["s"][0]
+
+        with open(s, "rb") as f:
+            signature_bytes = f.read()
+
+        digest = digest.replace(":", "=")
+        ref = f"{repo_name}@{digest}"
+        sigs = signatures.setdefault(ref, [])
+        sigs.append(signature_bytes)
+        self.send_empty_response(200)
+
+    def post_auth_config(self):
+        global required_token
+        required_token = self.query.get("token", [None])[0]
+
+        self.send_empty_response(200)
+
+    def do_POST(self):
+        handler = self.dispatch("POST")
+        if handler is None:
+            self.send_empty_response(404)
         else:
-            self.send_response(404)
-            self.end_headers()
-            return
+            with lock:
+                handler()
 
-    def do_DELETE(self):
-        if self.check_route("/testing/@repo_name/@ref"):
-            repo_name = self.matches["repo_name"]
-            ref = self.matches["ref"]
-
-            repo = repositories.setdefault(repo_name, {})
-            repo.setdefault("blobs", {})
-            manifests = repo.setdefault("manifests", {})
-            images = repo.setdefault("images", [])
-
-            image = None
-            for i in images:
-                if i["Digest"] == ref or ref in i["Tags"]:
+    def delete_image(self):
+        repo_name = self.matches["repo_name"]
+        ref = self.matches["ref"]
+
+        repo = get_repository(repo_name)
+        manifests = repo["manifests"]
+        images_by_tag = repo["images_by_tag"]
+
+        image = images_by_tag.get(ref)
+        if image is None:
+            for i in images_by_tag.values():
+                if i["Digest"] == ref:
                     image = i
                     break
 
-            assert image
+        assert image
 
-            images.remove(image)
-            del manifests[image["Digest"]]
-            for t in image["Tags"]:
-                del manifests[t]
+        del manifests[image["Digest"]]
+        for t in image["Tags"]:
+            del manifests[t]
+            del images_by_tag[t]
 
-            modified()
-            self.send_response(200)
-            self.end_headers()
-            return
-        elif self.check_route("/testing-sig/@repo_name/@digest"):
-            repo_name = self.matches["repo_name"]
-            digest = self.matches["digest"]
-
-            digest = digest.replace(":", "=")
-            ref = f"{repo_name}@{digest}"
-            signatures[ref] = list()
-            self.send_response(200)
-            self.end_headers()
-            return
+        modified()
+        self.send_empty_response(200)
+
+    def delete_signature(self):
+        repo_name = self.matches["repo_name"]
+        digest = self.matches["digest"]
+
+        digest = digest.replace(":", "=")
+        ref = f"{repo_name}@{digest}"
+        signatures[ref] = list()
+        self.send_empty_response(200)
+
+    def do_DELETE(self):
+        handler = self.dispatch("DELETE")
+        if handler is None:
+            self.send_empty_response(404)
         else:
-            self.send_response(404)
-            self.end_headers()
-            return
+            with lock:
+                handler()
 
 
 def run(args):
-    RequestHandler.protocol_version = "HTTP/1.0"
-    httpd = http_server.HTTPServer(("127.0.0.1", 0), RequestHandler)
+    httpd = http_server.ThreadingHTTPServer(("127.0.0.1", 0), RequestHandler)
 
     if args.cert:
         context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        context.options |= ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        context.options |= ssl.OP_NO_RENEGOTIATION
         context.load_cert_chain(certfile=args.cert, keyfile=args.key)
 
         if args.mtls_cacert:
@@ -338,6 +586,12 @@ def run(args):
         print("Serving HTTP on port %d" % port)
     if args.dir:
         os.chdir(args.dir)
+
+    # Keep detached icons on disk rather than in memory; this lives in
+    # the test directory, so it is cleaned up along with it
+    global icons_dir
+    icons_dir = os.path.abspath(tempfile.mkdtemp(prefix="oci-registry-icons-", dir="."))
+
     httpd.serve_forever()
 
 